@@ -0,0 +1,42 @@
+"""
+SKANA - Migración de tickets a subcolección
+Copia los tickets embebidos en users/{uid}.tickets a users/{uid}/tickets/{tid}.
+Se ejecuta una sola vez, a mano: python migrate_tickets.py
+"""
+
+from google.api_core.exceptions import AlreadyExists
+from firebase_admin import firestore
+
+from skana_backend import get_db, init_firebase, logger
+
+def migrate_tickets_to_subcollection():
+    """Crea los documentos de tickets que aún no existen en la subcolección.
+
+    Los ids son deterministas (id del ticket o '{uid}_{índice}') y se usa
+    create(), así que volver a ejecutar la migración no duplica tickets ni
+    sobrescribe los que ya cambiaron de estado.
+    """
+    logger.info("🚚 Migrando tickets a subcolección...")
+    db = get_db()
+    migrated = skipped = 0
+    
+    for doc in db.collection('users').stream():
+        tickets_ref = doc.reference.collection('tickets')
+        for idx, ticket in enumerate(doc.to_dict().get('tickets', [])):
+            ticket = dict(ticket)
+            ticket_id = str(ticket['id']) if ticket.get('id') else f"{doc.id}_{idx}"
+            # El filtro 'not-in' excluye documentos sin el campo status
+            ticket.setdefault('status', 'pending')
+            # Toda escritura de tickets debe marcar updatedAt (lecturas incrementales)
+            ticket['updatedAt'] = firestore.SERVER_TIMESTAMP
+            try:
+                tickets_ref.document(ticket_id).create(ticket)
+                migrated += 1
+            except AlreadyExists:
+                skipped += 1
+    
+    logger.info("✅ %d tickets migrados, %d ya existían", migrated, skipped)
+
+if __name__ == '__main__':
+    if init_firebase():
+        migrate_tickets_to_subcollection()
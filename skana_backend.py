@@ -4,26 +4,60 @@ Diseñado para ejecutar en Railway.app
 """
 
 import os
+import sys
 import json
+import asyncio
+import logging
+import signal
+import threading
 import time
-import requests
-from datetime import datetime
+import httpx
+import orjson
+from datetime import datetime, timedelta, timezone
+from array import array
+from dataclasses import dataclass, field
 import firebase_admin
 from firebase_admin import credentials, firestore, messaging
+from google.cloud.firestore_v1.base_query import FieldFilter
 
 # =====================
 # CONFIGURACIÓN
 # =====================
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO'),
+    format='%(asctime)s %(levelname)s %(message)s'
+)
+logger = logging.getLogger('skana')
+
 FOOTBALL_API_KEY = os.environ.get('FOOTBALL_API_KEY', '7ddda5241ad74811929323c8e39aa0db')
 FOOTBALL_API_URL = 'https://api.football-data.org/v4'
 CHECK_INTERVAL = 60  # segundos
+FINISHED_INTERVAL = 300  # segundos entre consultas de partidos finalizados
+DEVICES_CACHE_TTL = 300  # segundos
+TICKETS_FULL_SCAN_INTERVAL = 3600  # segundos entre lecturas completas de tickets
+TICKETS_CLOCK_SKEW = 5  # segundos de margen en lecturas incrementales
+TERMINAL_TICKET_STATUSES = ['won', 'lost']
+_TERMINAL = frozenset(TERMINAL_TICKET_STATUSES)
+
+def create_http_client():
+    """Cliente HTTP/2 asíncrono y reutilizable (keep-alive) para football-data"""
+    return httpx.AsyncClient(
+        headers={'X-Auth-Token': FOOTBALL_API_KEY},
+        timeout=10,
+        # Con transport= el cliente ignora limits, por eso van en el transporte
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=2,
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=4)
+        )
+    )
 
 # =====================
 # INICIALIZAR FIREBASE
 # =====================
 def init_firebase():
     """Inicializa Firebase usando credenciales desde variable de entorno o archivo"""
-    print("🔥 Inicializando Firebase...")
+    logger.info("🔥 Inicializando Firebase...")
     
     try:
         # Opción 1: Credenciales desde variable de entorno (Railway)
@@ -37,53 +71,112 @@ def init_firebase():
             raise Exception("No se encontraron credenciales de Firebase")
         
         firebase_admin.initialize_app(cred)
-        print(f"✅ Firebase conectado - Proyecto: {firebase_admin.get_app().project_id}")
+        logger.info("✅ Firebase conectado - Proyecto: %s", firebase_admin.get_app().project_id)
         return True
     except Exception as e:
-        print(f"❌ Error inicializando Firebase: {e}")
+        logger.error("❌ Error inicializando Firebase: %s", e)
         return False
 
+_DB = None
+
+def get_db():
+    """Retorna el cliente de Firestore, creándolo una sola vez"""
+    global _DB
+    if _DB is None:
+        _DB = firestore.client()
+    return _DB
+
 # =====================
 # OBTENER PARTIDOS
 # =====================
-def get_live_matches():
-    """Obtiene partidos en vivo y finalizados hoy"""
+async def get_live_matches_active(client):
+    """Obtiene partidos en vivo (se consulta en cada revisión)"""
     try:
-        headers = {'X-Auth-Token': FOOTBALL_API_KEY}
-        
         # Intentar partidos en vivo
-        response = requests.get(
-            f'{FOOTBALL_API_URL}/matches?status=LIVE,IN_PLAY,PAUSED,FINISHED',
-            headers=headers,
-            timeout=10
+        response = await client.get(
+            f'{FOOTBALL_API_URL}/matches?status=LIVE,IN_PLAY,PAUSED'
         )
         
         if response.status_code == 200:
-            data = response.json()
+            data = orjson.loads(response.content)
             return data.get('matches', [])
         else:
             # Fallback: partidos de hoy
             today = datetime.now().strftime('%Y-%m-%d')
-            response = requests.get(
-                f'{FOOTBALL_API_URL}/matches?dateFrom={today}&dateTo={today}',
-                headers=headers,
-                timeout=10
+            response = await client.get(
+                f'{FOOTBALL_API_URL}/matches?dateFrom={today}&dateTo={today}'
             )
             if response.status_code == 200:
-                return response.json().get('matches', [])
+                return orjson.loads(response.content).get('matches', [])
         
         return []
     except Exception as e:
-        print(f"   ⚠️ Error obteniendo partidos: {e}")
+        logger.warning("⚠️ Error obteniendo partidos: %s", e)
         return []
 
+async def get_recently_finished(client):
+    """Obtiene partidos finalizados (se consulta cada FINISHED_INTERVAL)"""
+    try:
+        response = await client.get(f'{FOOTBALL_API_URL}/matches?status=FINISHED')
+        if response.status_code == 200:
+            return orjson.loads(response.content).get('matches', [])
+        return []
+    except Exception as e:
+        logger.warning("⚠️ Error obteniendo partidos finalizados: %s", e)
+        return []
+
+def merge_matches(*match_lists):
+    """Une listas de partidos por id; la última lista tiene prioridad"""
+    merged = {}
+    for matches in match_lists:
+        for match in matches:
+            merged[match.get('id')] = match
+    return list(merged.values())
+
+@dataclass
+class MatchSoA:
+    """Partidos en arreglos paralelos (uno por campo) indexados por posición"""
+    ids: list = field(default_factory=list)
+    statuses: list = field(default_factory=list)
+    home_scores: array = field(default_factory=lambda: array('h'))
+    away_scores: array = field(default_factory=lambda: array('h'))
+    home_names: list = field(default_factory=list)
+    away_names: list = field(default_factory=list)
+    index: dict = field(default_factory=dict)  # match_id -> posición
+
+def build_match_soa(matches):
+    """Convierte la respuesta de la API a MatchSoA con sólo los campos usados"""
+    soa = MatchSoA()
+    
+    for match in matches:
+        match_id = match.get('id')
+        if match_id is None:
+            continue
+        
+        score = match.get('score', {})
+        soa.index[match_id] = len(soa.ids)
+        soa.ids.append(match_id)
+        soa.statuses.append(match.get('status'))
+        soa.home_scores.append(score.get('fullTime', {}).get('home') or score.get('halfTime', {}).get('home') or 0)
+        soa.away_scores.append(score.get('fullTime', {}).get('away') or score.get('halfTime', {}).get('away') or 0)
+        soa.home_names.append(match.get('homeTeam', {}).get('name', 'Local'))
+        soa.away_names.append(match.get('awayTeam', {}).get('name', 'Visitante'))
+    
+    return soa
+
 # =====================
 # OBTENER DISPOSITIVOS
 # =====================
+# Cache de dispositivos: los tokens cambian con poca frecuencia
+_cached_devices = {'at': 0, 'val': []}
+
 def get_devices():
-    """Obtiene todos los dispositivos registrados de Firestore"""
+    """Obtiene todos los dispositivos registrados de Firestore (con cache de 5 min)"""
+    if time.time() - _cached_devices['at'] < DEVICES_CACHE_TTL:
+        return _cached_devices['val']
+    
     try:
-        db = firestore.client()
+        db = get_db()
         devices_ref = db.collection('devices')
         devices = []
         
@@ -95,220 +188,415 @@ def get_devices():
                     'token': device_data['token']
                 })
         
+        _cached_devices['val'] = devices
+        _cached_devices['at'] = time.time()
         return devices
     except Exception as e:
-        print(f"   ⚠️ Error obteniendo dispositivos: {e}")
-        return []
+        logger.warning("⚠️ Error obteniendo dispositivos: %s", e)
+        return _cached_devices['val']
+
+def invalidate_devices_cache():
+    """Fuerza a recargar los dispositivos en la próxima revisión"""
+    _cached_devices['at'] = 0
 
 # =====================
 # OBTENER TICKETS
 # =====================
+# Cache de tickets activos: ruta del documento -> ticket
+_all_tickets_cache = {}
+_last_ticket_scan_ts = None
+_last_full_ticket_scan = 0
+
+def _load_ticket(doc):
+    """Convierte un documento de ticket al dict usado por process_matches"""
+    ticket = doc.to_dict()
+    ticket['userId'] = doc.reference.parent.parent.id
+    
+    # Pre-parsear apuestas de resultado exacto una sola vez
+    for bet in ticket.get('bets', []):
+        selection = bet.get('selection', '')
+        if selection.startswith('CS'):
+            bet['_cs'] = parse_correct_score(selection)
+    
+    return ticket
+
 def get_all_tickets():
-    """Obtiene todos los tickets de todos los usuarios"""
+    """Obtiene los tickets activos de todos los usuarios.
+
+    Los tickets viven en la subcolección users/{uid}/tickets. La primera
+    lectura (y una vez por hora) trae todos los tickets abiertos; las demás
+    sólo los modificados desde la última revisión según su campo updatedAt.
+    Ambas consultas requieren los índices de firestore.indexes.json.
+    """
+    global _last_ticket_scan_ts, _last_full_ticket_scan
+    
     try:
-        db = firestore.client()
-        users_ref = db.collection('users')
-        all_tickets = []
+        db = get_db()
+        scan_started = datetime.now(timezone.utc)
         
-        for doc in users_ref.stream():
-            user_data = doc.to_dict()
-            tickets = user_data.get('tickets', [])
-            for ticket in tickets:
-                ticket['userId'] = doc.id
-                all_tickets.append(ticket)
+        if _last_ticket_scan_ts is None or time.time() - _last_full_ticket_scan > TICKETS_FULL_SCAN_INTERVAL:
+            # Lectura completa: el filtro de estado se resuelve en Firestore
+            query = db.collection_group('tickets').where(
+                filter=FieldFilter('status', 'not-in', TERMINAL_TICKET_STATUSES)
+            )
+            tickets = {doc.reference.path: _load_ticket(doc) for doc in query.stream()}
+            _all_tickets_cache.clear()
+            _all_tickets_cache.update(tickets)
+            _last_full_ticket_scan = time.time()
+        else:
+            # Lectura incremental: incluye tickets que pasaron a won/lost para sacarlos
+            query = db.collection_group('tickets').where(
+                filter=FieldFilter('updatedAt', '>=', _last_ticket_scan_ts)
+            )
+            for doc in query.stream():
+                ticket = _load_ticket(doc)
+                if ticket.get('status') in _TERMINAL:
+                    _all_tickets_cache.pop(doc.reference.path, None)
+                else:
+                    _all_tickets_cache[doc.reference.path] = ticket
         
-        return all_tickets
+        # Margen para tolerar diferencias de reloj con el servidor
+        _last_ticket_scan_ts = scan_started - timedelta(seconds=TICKETS_CLOCK_SKEW)
+        return list(_all_tickets_cache.values())
     except Exception as e:
-        print(f"   ⚠️ Error obteniendo tickets: {e}")
-        return []
+        logger.error("❌ Error obteniendo tickets (¿faltan índices de firestore.indexes.json?): %s", e)
+        return list(_all_tickets_cache.values())
 
 # =====================
 # ENVIAR NOTIFICACIÓN
 # =====================
-def send_notification(token, title, body, data=None):
-    """Envía una notificación push a un dispositivo"""
+FCM_MULTICAST_LIMIT = 500  # máximo de tokens por MulticastMessage
+
+def send_event(tokens, title, body, data=None):
+    """Envía una notificación push a varios dispositivos en lotes de 500 tokens.
+
+    Retorna una tupla (enviadas, tokens_inválidos) con la cantidad de
+    notificaciones entregadas y los tokens rechazados por FCM.
+    """
+    sent = 0
+    invalid_tokens = []
+    
+    # Notificación y datos son iguales para todos los lotes: se crean una vez
+    notification = messaging.Notification(title=title, body=body)
+    data = data or {}
+    
+    for i in range(0, len(tokens), FCM_MULTICAST_LIMIT):
+        chunk = tokens[i:i + FCM_MULTICAST_LIMIT]
+        try:
+            message = messaging.MulticastMessage(
+                tokens=chunk,
+                notification=notification,
+                data=data
+            )
+            
+            response = messaging.send_each_for_multicast(message)
+            sent += response.success_count
+            logger.debug("📤 Notificación enviada: %s (%d/%d)", title, response.success_count, len(chunk))
+            
+            # Detectar tokens inválidos o dados de baja
+            for token, resp in zip(chunk, response.responses):
+                if resp.success:
+                    continue
+                if isinstance(resp.exception, (messaging.UnregisteredError,
+                                               messaging.SenderIdMismatchError)):
+                    invalid_tokens.append(token)
+                else:
+                    logger.warning("❌ Error enviando a %.12s...: %s", token, resp.exception)
+        except Exception as e:
+            logger.error("❌ Error enviando notificación: %s", e)
+    
+    if invalid_tokens:
+        logger.info("🧹 %d tokens inválidos", len(invalid_tokens))
+    return sent, invalid_tokens
+
+def prune_devices(devices, invalid_tokens):
+    """Elimina de Firestore los dispositivos cuyos tokens FCM ya no son válidos"""
     try:
-        message = messaging.Message(
-            notification=messaging.Notification(
-                title=title,
-                body=body
-            ),
-            data=data or {},
-            token=token
-        )
-        
-        response = messaging.send(message)
-        print(f"   📤 Notificación enviada: {title}")
-        return True
+        db = get_db()
+        for device in devices:
+            if device['token'] in invalid_tokens:
+                db.collection('devices').document(device['id']).delete()
+                logger.debug("🗑️ Dispositivo eliminado: %s", device['id'])
     except Exception as e:
-        print(f"   ❌ Error enviando notificación: {e}")
-        return False
+        logger.warning("⚠️ Error eliminando dispositivos: %s", e)
+    finally:
+        invalidate_devices_cache()
 
 # =====================
 # PROCESAR PARTIDOS
 # =====================
-# Cache para evitar notificaciones duplicadas
-notified_events = set()
+# Cache para evitar notificaciones duplicadas: match_id -> {tipo_evento: timestamp}
+notified_events = {}
 # Cache para guardar marcadores anteriores
 previous_scores = {}
+# Vencimiento de ambos caches por partido; se renueva cada vez que el partido
+# aparece en el feed (incluido cuando se reporta FINISHED)
+match_expiry = {}
+NOTIFIED_EVENTS_TTL = 86400  # segundos desde la última aparición en el feed
 
-def process_matches(matches, tickets, devices):
-    """Procesa partidos y envía notificaciones según los tickets"""
+def detect_events(matches, tickets):
+    """Detecta los eventos pendientes de notificar según los tickets.
+
+    Retorna un dict (match_id, tipo_evento) -> {'title', 'body', 'data'}.
+    """
     global previous_scores
     
-    for ticket in tickets:
-        if ticket.get('status') == 'won' or ticket.get('status') == 'lost':
-            continue  # Ticket ya finalizado
-        
+    # Partidos en arreglos paralelos con índice por id para búsquedas O(1)
+    soa = build_match_soa(matches)
+    
+    # Descartar tickets finalizados o sin apuestas en los partidos de hoy
+    relevant = [
+        t for t in tickets
+        if t.get('status') not in _TERMINAL
+        and any(b.get('matchId') in soa.index for b in t.get('bets', []))
+    ]
+    
+    # Agrupar apuestas activas por partido
+    bets_by_match = {}
+    for ticket in relevant:
         for bet in ticket.get('bets', []):
             match_id = bet.get('matchId')
-            if not match_id:
-                continue
-            
-            # Buscar el partido en vivo
-            match = next((m for m in matches if m.get('id') == match_id), None)
-            if not match:
-                continue
-            
-            home_team = match.get('homeTeam', {}).get('name', 'Local')
-            away_team = match.get('awayTeam', {}).get('name', 'Visitante')
-            match_status = match.get('status')
-            
-            # Obtener marcador actual
-            score = match.get('score', {})
-            home_score = score.get('fullTime', {}).get('home') or score.get('halfTime', {}).get('home') or 0
-            away_score = score.get('fullTime', {}).get('away') or score.get('halfTime', {}).get('away') or 0
-            current_score = f"{home_score}-{away_score}"
-            
-            # Obtener marcador anterior
-            prev = previous_scores.get(match_id, {'home': 0, 'away': 0})
-            prev_home = prev.get('home', 0)
-            prev_away = prev.get('away', 0)
-            
-            # Evento: Partido comenzó
-            event_key = f"{match_id}_started"
-            if match_status in ['IN_PLAY', 'LIVE'] and event_key not in notified_events:
-                notified_events.add(event_key)
-                for device in devices:
-                    send_notification(
-                        device['token'],
-                        f"🏟️ ¡Comenzó! {home_team} vs {away_team}",
-                        "Tu apuesta está en juego",
-                        {'matchId': str(match_id), 'type': 'started'}
-                    )
-            
-            # Evento: Gol (detectar quién marcó)
-            score_key = f"{match_id}_score_{home_score}_{away_score}"
-            if match_status in ['IN_PLAY', 'LIVE', 'PAUSED'] and score_key not in notified_events:
-                # Detectar si hubo gol
-                if home_score > prev_home:
-                    # Gol del equipo local
-                    notified_events.add(score_key)
-                    for device in devices:
-                        send_notification(
-                            device['token'],
-                            f"⚽ ¡GOL de {home_team}!",
-                            f"{home_team} {home_score} - {away_score} {away_team}",
-                            {'matchId': str(match_id), 'type': 'goal', 'scorer': 'home'}
-                        )
-                elif away_score > prev_away:
-                    # Gol del equipo visitante
-                    notified_events.add(score_key)
-                    for device in devices:
-                        send_notification(
-                            device['token'],
-                            f"⚽ ¡GOL de {away_team}!",
-                            f"{home_team} {home_score} - {away_score} {away_team}",
-                            {'matchId': str(match_id), 'type': 'goal', 'scorer': 'away'}
-                        )
-            
-            # Actualizar marcador anterior
+            if match_id and match_id in soa.index:
+                bets_by_match.setdefault(match_id, []).append(bet)
+    
+    # Renovar el vencimiento de los partidos seguidos que siguen en el feed
+    expires_at = time.time() + NOTIFIED_EVENTS_TTL
+    for match_id in soa.ids:
+        if match_id in bets_by_match or match_id in match_expiry:
+            match_expiry[match_id] = expires_at
+    
+    # Paso 1: detectar eventos una sola vez por partido
+    pending_events = {}
+    for match_id, bets in bets_by_match.items():
+        i = soa.index[match_id]
+        home_team, away_team, match_status = soa.home_names[i], soa.away_names[i], soa.statuses[i]
+        home_score, away_score = soa.home_scores[i], soa.away_scores[i]
+        
+        # Obtener marcador anterior
+        prev = previous_scores.get(match_id, {'home': 0, 'away': 0})
+        prev_home = prev.get('home', 0)
+        prev_away = prev.get('away', 0)
+        
+        notified = notified_events.get(match_id, ())
+        
+        # Evento: Partido comenzó
+        if match_status in ['IN_PLAY', 'LIVE'] and 'started' not in notified:
+            pending_events[(match_id, 'started')] = {
+                'title': f"🏟️ ¡Comenzó! {home_team} vs {away_team}",
+                'body': "Tu apuesta está en juego",
+                'data': {'matchId': str(match_id), 'type': 'started'}
+            }
+        
+        # Evento: Gol (detectar quién marcó)
+        score_key = f"score_{home_score}_{away_score}"
+        if match_status in ['IN_PLAY', 'LIVE', 'PAUSED'] and score_key not in notified:
+            if home_score > prev_home:
+                # Gol del equipo local
+                pending_events[(match_id, score_key)] = {
+                    'title': f"⚽ ¡GOL de {home_team}!",
+                    'body': f"{home_team} {home_score} - {away_score} {away_team}",
+                    'data': {'matchId': str(match_id), 'type': 'goal', 'scorer': 'home'},
+                    'score': {'home': home_score, 'away': away_score}
+                }
+            elif away_score > prev_away:
+                # Gol del equipo visitante
+                pending_events[(match_id, score_key)] = {
+                    'title': f"⚽ ¡GOL de {away_team}!",
+                    'body': f"{home_team} {home_score} - {away_score} {away_team}",
+                    'data': {'matchId': str(match_id), 'type': 'goal', 'scorer': 'away'},
+                    'score': {'home': home_score, 'away': away_score}
+                }
+        
+        # Actualizar marcador anterior (si hay un gol pendiente, se actualiza
+        # recién cuando el envío tiene éxito para reintentarlo si falla)
+        if (match_id, score_key) not in pending_events:
             previous_scores[match_id] = {'home': home_score, 'away': away_score}
+        
+        # Evento: Partido terminó
+        if match_status == 'FINISHED' and 'finished' not in notified:
+            # Evaluar apuesta según tipo
+            total_goals = home_score + away_score
             
-            # Evento: Partido terminó
-            event_key = f"{match_id}_finished"
-            if match_status == 'FINISHED' and event_key not in notified_events:
-                notified_events.add(event_key)
-                
-                # Evaluar apuesta según tipo
-                selection = bet.get('selection', '1')
-                total_goals = home_score + away_score
-                
-                won = evaluate_bet(selection, home_score, away_score, total_goals)
-                
-                for device in devices:
-                    if won:
-                        send_notification(
-                            device['token'],
-                            f"🎉 ¡GANASTE! {home_team} vs {away_team}",
-                            f"Final: {home_score} - {away_score}",
-                            {'matchId': str(match_id), 'type': 'won'}
-                        )
-                    else:
-                        send_notification(
-                            device['token'],
-                            f"😢 Perdiste: {home_team} vs {away_team}",
-                            f"Final: {home_score} - {away_score}",
-                            {'matchId': str(match_id), 'type': 'lost'}
-                        )
-
-def evaluate_bet(selection, home_score, away_score, total_goals):
-    """Evalúa si la apuesta fue ganadora según el tipo de mercado"""
+            if evaluate_bet(bets[0], home_score, away_score, total_goals):
+                pending_events[(match_id, 'finished')] = {
+                    'title': f"🎉 ¡GANASTE! {home_team} vs {away_team}",
+                    'body': f"Final: {home_score} - {away_score}",
+                    'data': {'matchId': str(match_id), 'type': 'won'}
+                }
+            else:
+                pending_events[(match_id, 'finished')] = {
+                    'title': f"😢 Perdiste: {home_team} vs {away_team}",
+                    'body': f"Final: {home_score} - {away_score}",
+                    'data': {'matchId': str(match_id), 'type': 'lost'}
+                }
+    
+    return pending_events
+
+async def process_matches_async(matches, tickets, devices):
+    """Procesa partidos y envía notificaciones según los tickets"""
+    # Sin el historial restaurado se reenviaría todo: no enviar hasta cargarlo
+    if not await asyncio.to_thread(load_notified_events):
+        logger.error("❌ Historial de notificaciones no disponible; se omite el envío")
+        return
+    
+    pending_events = detect_events(matches, tickets)
+    tokens = [d['token'] for d in devices]
+    invalid_tokens = set()
+    
+    # Enviar todos los eventos en paralelo, cada uno una sola vez
+    results = await asyncio.gather(*[
+        asyncio.to_thread(send_event, tokens, event['title'], event['body'], event['data'])
+        for event in pending_events.values()
+    ])
+    
+    for ((match_id, kind), event), (sent, invalid) in zip(pending_events.items(), results):
+        invalid_tokens.update(invalid)
+        if sent:
+            notified_events.setdefault(match_id, {})[kind] = time.time()
+            if 'score' in event:
+                previous_scores[match_id] = event['score']
+            schedule_save_notified_events()
+    
+    if invalid_tokens:
+        await asyncio.to_thread(prune_devices, devices, invalid_tokens)
+    
+    purge_notified_events()
+
+def purge_notified_events():
+    """Descarta los partidos que no aparecen en el feed hace más de 24 h"""
+    now = time.time()
+    for match_id, expires_at in list(match_expiry.items()):
+        if expires_at < now:
+            del match_expiry[match_id]
+            previous_scores.pop(match_id, None)
+            if notified_events.pop(match_id, None) is not None:
+                schedule_save_notified_events()
+
+# =====================
+# PERSISTIR EVENTOS NOTIFICADOS
+# =====================
+# Guardar notified_events en Firestore evita reenviar todo tras un reinicio
+NOTIFIED_EVENTS_SAVE_DELAY = 10  # segundos mínimos entre escrituras
+_notified_events_loaded = False
+_save_timer = None
+_save_lock = threading.Lock()
+
+def _notified_events_doc():
+    return get_db().collection('system').document('notified_events')
+
+def load_notified_events():
+    """Carga los eventos ya notificados desde Firestore (una vez por proceso).
+
+    Retorna True si el historial está disponible.
+    """
+    global _notified_events_loaded
+    if _notified_events_loaded:
+        return True
+    
+    try:
+        doc = _notified_events_doc().get()
+        if doc.exists:
+            # Firestore sólo admite claves de texto; los ids de partido son enteros
+            data = doc.to_dict()
+            expiry = data.get('expiry') or {}
+            default_expiry = time.time() + NOTIFIED_EVENTS_TTL
+            for match_id, events in (data.get('events') or {}).items():
+                key = int(match_id) if match_id.isdigit() else match_id
+                notified_events.setdefault(key, {}).update(events)
+                match_expiry.setdefault(key, expiry.get(match_id, default_expiry))
+            logger.info("💾 %d partidos notificados restaurados", len(notified_events))
+        _notified_events_loaded = True
+        return True
+    except Exception as e:
+        logger.warning("⚠️ Error cargando eventos notificados: %s", e)
+        return False
+
+def schedule_save_notified_events():
+    """Programa una escritura diferida; agrupa los cambios de los próximos segundos"""
+    global _save_timer
+    with _save_lock:
+        if _save_timer is None:
+            _save_timer = threading.Timer(NOTIFIED_EVENTS_SAVE_DELAY, save_notified_events)
+            _save_timer.daemon = True
+            _save_timer.start()
+
+def save_notified_events():
+    """Escribe el estado actual de notified_events en Firestore"""
+    global _save_timer
+    with _save_lock:
+        _save_timer = None
     
+    try:
+        events = {str(match_id): dict(kinds) for match_id, kinds in list(notified_events.items())}
+        expiry = {str(match_id): expires_at for match_id, expires_at in list(match_expiry.items())
+                  if str(match_id) in events}
+        _notified_events_doc().set({'events': events, 'expiry': expiry, 'updatedAt': time.time()})
+    except Exception as e:
+        logger.warning("⚠️ Error guardando eventos notificados: %s", e)
+
+def flush_notified_events():
+    """Escribe de inmediato la escritura pendiente (al detener el proceso)"""
+    global _save_timer
+    with _save_lock:
+        timer, _save_timer = _save_timer, None
+    if timer is not None:
+        timer.cancel()
+    # Sólo si se cargó: guardar un historial vacío borraría el de Firestore
+    if _notified_events_loaded:
+        save_notified_events()
+
+# Reglas por mercado: selección -> fn(goles_local, goles_visitante, total_goles)
+_BET_RULES = {
     # 1X2 - Resultado final
-    if selection == '1':
-        return home_score > away_score
-    elif selection == 'X':
-        return home_score == away_score
-    elif selection == '2':
-        return away_score > home_score
+    '1': lambda h, a, t: h > a,
+    'X': lambda h, a, t: h == a,
+    '2': lambda h, a, t: a > h,
     
     # Doble Oportunidad
-    elif selection == '1X':
-        return home_score >= away_score
-    elif selection == 'X2':
-        return away_score >= home_score
-    elif selection == '12':
-        return home_score != away_score
-    
-    # Over/Under
-    elif selection == 'O1.5':
-        return total_goals > 1.5
-    elif selection == 'O2.5':
-        return total_goals > 2.5
-    elif selection == 'O3.5':
-        return total_goals > 3.5
-    elif selection == 'U1.5':
-        return total_goals < 1.5
-    elif selection == 'U2.5':
-        return total_goals < 2.5
-    elif selection == 'U3.5':
-        return total_goals < 3.5
+    '1X': lambda h, a, t: h >= a,
+    'X2': lambda h, a, t: a >= h,
+    '12': lambda h, a, t: h != a,
+    
+    # Over/Under (comparaciones enteras: O1.5 equivale a t >= 2)
+    'O1.5': lambda h, a, t: t >= 2,
+    'O2.5': lambda h, a, t: t >= 3,
+    'O3.5': lambda h, a, t: t >= 4,
+    'U1.5': lambda h, a, t: t <= 1,
+    'U2.5': lambda h, a, t: t <= 2,
+    'U3.5': lambda h, a, t: t <= 3,
     
     # BTTS (Ambos marcan)
-    elif selection == 'BTTS_Y':
-        return home_score > 0 and away_score > 0
-    elif selection == 'BTTS_N':
-        return home_score == 0 or away_score == 0
+    'BTTS_Y': lambda h, a, t: h > 0 and a > 0,
+    'BTTS_N': lambda h, a, t: h == 0 or a == 0,
     
     # Handicap
-    elif selection == 'H1-1':
-        return (home_score - 1) > away_score
-    elif selection == 'H1+1':
-        return (home_score + 1) > away_score
-    elif selection == 'H2-1':
-        return away_score - 1 > home_score
-    elif selection == 'H2+1':
-        return away_score + 1 > home_score
-    
-    # Resultado exacto
-    elif selection.startswith('CS'):
-        exact_score = selection.replace('CS', '')
-        parts = exact_score.split('-')
-        if len(parts) == 2:
-            expected_home = int(parts[0])
-            expected_away = int(parts[1])
-            return home_score == expected_home and away_score == expected_away
+    'H1-1': lambda h, a, t: h - 1 > a,
+    'H1+1': lambda h, a, t: h + 1 > a,
+    'H2-1': lambda h, a, t: a - 1 > h,
+    'H2+1': lambda h, a, t: a + 1 > h,
+}
+
+def parse_correct_score(selection):
+    """Convierte 'CS2-1' en (2, 1); retorna None si no es un resultado exacto válido"""
+    parts = selection[2:].split('-')
+    if len(parts) != 2:
+        return None
+    try:
+        return int(parts[0]), int(parts[1])
+    except ValueError:
+        return None
+
+def evaluate_bet(bet, home_score, away_score, total_goals):
+    """Evalúa si la apuesta fue ganadora según el tipo de mercado"""
+    selection = bet.get('selection', '1')
+    rule = _BET_RULES.get(selection)
+    if rule:
+        return rule(home_score, away_score, total_goals)
+    
+    # Resultado exacto (pre-parseado en get_all_tickets)
+    if selection.startswith('CS'):
+        expected = bet['_cs'] if '_cs' in bet else parse_correct_score(selection)
+        return expected == (home_score, away_score)
     
     # Default: no ganó
     return False
@@ -316,41 +604,57 @@ def evaluate_bet(selection, home_score, away_score, total_goals):
 # =====================
 # LOOP PRINCIPAL
 # =====================
+async def run_cycle(client, include_finished=False):
+    """Ejecuta una revisión: lecturas en paralelo y envío de notificaciones"""
+    # Obtener datos (en paralelo; cada función maneja sus propios errores)
+    active, finished, devices, tickets = await asyncio.gather(
+        get_live_matches_active(client),
+        get_recently_finished(client) if include_finished else asyncio.sleep(0, result=[]),
+        asyncio.to_thread(get_devices),
+        asyncio.to_thread(get_all_tickets)
+    )
+    matches = merge_matches(active, finished)
+    
+    logger.info(
+        "⏰ Revisión: %d partidos, %d dispositivos, %d tickets activos",
+        len(matches), len(devices), len(tickets)
+    )
+    
+    # Procesar
+    if matches and devices and tickets:
+        await process_matches_async(matches, tickets, devices)
+
+async def run_loop():
+    """Revisa partidos cada CHECK_INTERVAL segundos"""
+    finished_every = max(1, FINISHED_INTERVAL // CHECK_INTERVAL)
+    cycle = 0
+    
+    async with create_http_client() as client:
+        while True:
+            try:
+                await run_cycle(client, include_finished=cycle % finished_every == 0)
+            except Exception as e:
+                logger.exception("❌ Error en loop principal: %s", e)
+            
+            # Esperar antes de la siguiente revisión
+            cycle += 1
+            await asyncio.sleep(CHECK_INTERVAL)
+
 def main():
-    print("=" * 50)
-    print("🎯 SKANA - Backend de Notificaciones")
-    print("=" * 50)
-    print(f"⏱️  Intervalo de revisión: {CHECK_INTERVAL} segundos")
-    print("   Presiona Ctrl+C para detener")
-    print()
+    logger.info("🎯 SKANA - Backend de Notificaciones")
+    logger.info("⏱️  Intervalo de revisión: %d segundos", CHECK_INTERVAL)
     
     if not init_firebase():
-        print("❌ No se pudo inicializar Firebase. Saliendo...")
+        logger.error("❌ No se pudo inicializar Firebase. Saliendo...")
         return
     
-    while True:
-        try:
-            now = datetime.now().strftime('%H:%M:%S')
-            print(f"⏰ {now} - Revisando partidos...")
-            
-            # Obtener datos
-            matches = get_live_matches()
-            devices = get_devices()
-            tickets = get_all_tickets()
-            
-            print(f"   📊 {len(matches)} partidos encontrados")
-            print(f"   📱 {len(devices)} dispositivos registrados")
-            print(f"   🎫 {len(tickets)} tickets activos")
-            
-            # Procesar
-            if matches and devices and tickets:
-                process_matches(matches, tickets, devices)
-            
-        except Exception as e:
-            print(f"   ❌ Error en loop principal: {e}")
-        
-        # Esperar antes de la siguiente revisión
-        time.sleep(CHECK_INTERVAL)
+    # Railway detiene el worker con SIGTERM: convertirlo en salida ordenada
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    try:
+        asyncio.run(run_loop())
+    finally:
+        flush_notified_events()
 
 if __name__ == '__main__':
     main()